@@ -0,0 +1,28 @@
+import hashlib
+import math
+
+
+class HyperLogLog:
+    # SQLite aggregate behind APPROX_COUNT_DISTINCT; 2**12 registers give ~1.6% standard error
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = [0] * (1 << precision)
+
+    def step(self, value):
+        if value is None:
+            return
+        hashed = int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        self.registers[index] = max(self.registers[index], rank)
+
+    def finalize(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        # Small cardinalities are counted more accurately from the empty registers
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import time
+
+from hyperloglog import HyperLogLog
+
+
+def load_workload(log_path):
+    with open(log_path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda entry: entry['timestamp'])
+
+
+def replay(entries, db_path, speed=1.0):
+    # Open with the same settings the server uses for snapshots, so replays
+    # against a snapshot measure the server's read path
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro&immutable=1", uri=True)
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.create_aggregate('APPROX_COUNT_DISTINCT', 1, HyperLogLog)
+    cursor = conn.cursor()
+
+    results = []
+    replay_start = time.perf_counter()
+    for entry in entries:
+        # Keep the original spacing between queries, compressed by `speed`
+        if speed > 0:
+            offset = (entry['timestamp'] - entries[0]['timestamp']) / speed
+            delay = offset - (time.perf_counter() - replay_start)
+            if delay > 0:
+                time.sleep(delay)
+
+        started = time.perf_counter()
+        try:
+            cursor.execute(entry['translated_query'])
+            row_count = len(cursor.fetchall())
+            error = None
+        except sqlite3.Error as e:
+            row_count = None
+            error = str(e)
+        duration_ms = (time.perf_counter() - started) * 1000
+
+        results.append({
+            'normalized_sql': entry['normalized_sql'],
+            # Logs written before this field existed only contain exact runs
+            'approximate': entry.get('approximate', False),
+            'original_ms': entry['duration_ms'],
+            'replay_ms': duration_ms,
+            'row_count_changed': row_count is not None and row_count != entry['row_count'],
+            'error': error
+        })
+
+    conn.close()
+    return results
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def print_report(results):
+    ok = [r for r in results if r['error'] is None]
+    print(f"Replayed {len(results)} queries ({len(results) - len(ok)} errors)")
+    if not ok:
+        return
+
+    original = [r['original_ms'] for r in ok]
+    replayed = [r['replay_ms'] for r in ok]
+    print(f"{'':>8} {'original':>12} {'replay':>12}")
+    for label, pct in (('p50', 50), ('p95', 95), ('p99', 99)):
+        print(f"{label:>8} {percentile(original, pct):>10.2f}ms {percentile(replayed, pct):>10.2f}ms")
+
+    # Group by normalized SQL so one regressed query shape stands out; sampled
+    # runs of the same SQL hit a different table, so they form their own group
+    by_shape = {}
+    for r in ok:
+        by_shape.setdefault((r['normalized_sql'], r['approximate']), []).append(r['replay_ms'] - r['original_ms'])
+    print("\nLargest latency changes by query shape:")
+    worst = sorted(by_shape.items(), key=lambda item: abs(statistics.mean(item[1])), reverse=True)
+    for (sql, approximate), deltas in worst[:10]:
+        mode = 'approx' if approximate else 'exact'
+        print(f"  {statistics.mean(deltas):+10.2f}ms  x{len(deltas):<4} {mode:<6} {sql[:100]}")
+
+    changed = sum(1 for r in ok if r['row_count_changed'])
+    if changed:
+        print(f"\n{changed} queries returned a different row count than when captured")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a captured slow-query log against a database snapshot')
+    parser.add_argument('log_path', help='NDJSON file written via SNOWFLAKE_SLOW_QUERY_LOG')
+    parser.add_argument('db_path', help='database or snapshot file to replay against')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='pace multiplier; 2 replays twice as fast, 0 runs back to back')
+    args = parser.parse_args()
+
+    print_report(replay(load_workload(args.log_path), args.db_path, speed=args.speed))
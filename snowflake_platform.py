@@ -5,12 +5,126 @@ import random
 import uuid
 import json
 import re
+import os
+import time
+import queue
+import hashlib
+import threading
+import math
+import logging
+from hyperloglog import HyperLogLog
 
 app = Flask(__name__)
 
+class SlowQueryLog:
+    def __init__(self, log_path, threshold_ms=100, sample_rate=0.0, max_pending=10000):
+        self.log_path = log_path
+        self.threshold_ms = threshold_ms
+        # Fraction of fast queries captured too, so the log doubles as a workload sample
+        self.sample_rate = sample_rate
+        self.entries = queue.Queue(maxsize=max_pending)
+        self.writer = threading.Thread(target=self.write_entries, daemon=True)
+        self.writer.start()
+
+    def should_log(self, duration_ms):
+        return duration_ms >= self.threshold_ms or random.random() < self.sample_rate
+
+    def record(self, entry):
+        # Never block the request on disk I/O; the writer thread drains the queue,
+        # and if it falls behind we drop entries rather than grow without bound
+        try:
+            self.entries.put_nowait(entry)
+        except queue.Full:
+            pass
+
+    def write_entries(self):
+        while True:
+            entry = self.entries.get()
+            try:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+                    # Batch up whatever else arrived while we were writing
+                    while not self.entries.empty():
+                        f.write(json.dumps(self.entries.get()) + '\n')
+            except OSError as e:
+                logging.getLogger(__name__).warning("Could not write slow query log %s: %s", self.log_path, e)
+
+def normalize_sql(query):
+    # Replace literals with placeholders so repeated queries group together
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", query)
+    normalized = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalized)
+    return re.sub(r"\s+", " ", normalized).strip()
+
+def top_level_positions(sql):
+    # Indexes outside string literals and parentheses
+    depth = 0
+    in_string = False
+    for i, ch in enumerate(sql):
+        if ch == "'":
+            in_string = not in_string
+        elif in_string:
+            continue
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif depth == 0:
+            yield i
+
+def find_closing_paren(sql, open_index):
+    depth = 0
+    in_string = False
+    for i in range(open_index, len(sql)):
+        ch = sql[i]
+        if ch == "'":
+            in_string = not in_string
+        elif in_string:
+            continue
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError('Unbalanced parentheses in query')
+
+def split_top_level(sql):
+    parts = []
+    start = 0
+    for i in top_level_positions(sql):
+        if sql[i] == ',':
+            parts.append(sql[start:i])
+            start = i + 1
+    parts.append(sql[start:])
+    return parts
+
+def split_alias(item):
+    # Split a select item into (expression, alias), alias None when there is none.
+    # Returns None when the item can't be parsed with confidence
+    alias_pattern = r"(\"(?:[^\"]|\"\")*\"|'(?:[^']|'')*'|\w+)"
+    match = re.search(rf"\s+AS\s+{alias_pattern}\s*$", item, flags=re.IGNORECASE)
+    if not match:
+        match = re.search(rf"(?<=[\w)\"'])\s+{alias_pattern}\s*$", item)
+        if match and match.group(1).upper() in ('END', 'NULL', 'TRUE', 'FALSE'):
+            match = None
+    expression = item[:match.start()] if match else item
+    if any(re.match(r"AS\b", expression[i:], flags=re.IGNORECASE) and not re.match(r"\w", expression[i - 1])
+           for i in top_level_positions(expression) if i > 0):
+        return None
+    return expression, match.group(1) if match else None
+
 class SnowflakePlatform:
-    def __init__(self, db_path='snowflake_gateway.db'):
+    # Tables with a stratified sample for approximate queries, keyed to their strata column
+    SAMPLE_TABLES = {'TRANSACTIONS': 'COUNTRY'}
+    SAMPLE_RATE = 0.1
+    # Small strata are oversampled so every group still gets a usable estimate
+    SAMPLE_MIN_ROWS = 30
+
+    def __init__(self, db_path='snowflake_gateway.db', snapshot_dir=None, slow_query_log=None):
         self.db_path = db_path
+        # When set, reads are served from immutable snapshots published here
+        self.snapshot_dir = snapshot_dir
+        self.slow_query_log = slow_query_log
         self.init_database()
 
     def init_database(self):
@@ -67,13 +181,124 @@ class SnowflakePlatform:
         ''')
 
         # Check if tables are empty and populate with sample data
+        data_loaded = False
         cursor.execute("SELECT COUNT(*) FROM TRANSACTIONS")
         if cursor.fetchone()[0] == 0:
             self.populate_sample_data(cursor)
+            self.refresh_samples(cursor)
+            data_loaded = True
+        
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        existing_tables = {row[0] for row in cursor.fetchall()}
+        if any(f"{table}_SAMPLE" not in existing_tables for table in self.SAMPLE_TABLES):
+            self.refresh_samples(cursor)
+            data_loaded = True
         
         conn.commit()
         conn.close()
 
+        # Only the process that loaded data publishes; other workers just read
+        # the snapshot already named in CURRENT
+        if self.snapshot_dir and (data_loaded or not os.path.exists(os.path.join(self.snapshot_dir, 'CURRENT'))):
+            self.publish_snapshot()
+
+    def publish_snapshot(self, grace_seconds=600):
+        # Copy the live database into a new versioned file, then swap the
+        # CURRENT pointer so readers move over atomically
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        version = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{os.getpid()}"
+        snapshot_name = f"snapshot_{version}.db"
+        snapshot_path = os.path.join(self.snapshot_dir, snapshot_name)
+
+        # Build under a temporary name so cleanup never sees a half-written copy
+        tmp_snapshot_path = f"{snapshot_path}.tmp"
+        source = sqlite3.connect(self.db_path)
+        target = sqlite3.connect(tmp_snapshot_path)
+        source.backup(target)
+        target.close()
+        source.close()
+        os.replace(tmp_snapshot_path, snapshot_path)
+
+        pointer_path = os.path.join(self.snapshot_dir, 'CURRENT')
+        try:
+            previous_path = self.current_snapshot_path()
+            # Mark when the old version stopped being current so its grace period starts now
+            os.utime(previous_path)
+        except FileNotFoundError:
+            pass
+
+        tmp_pointer_path = f"{pointer_path}.{os.getpid()}.tmp"
+        with open(tmp_pointer_path, 'w') as f:
+            f.write(snapshot_name)
+        os.replace(tmp_pointer_path, pointer_path)
+
+        # Drop versions superseded longer ago than the grace period, so readers
+        # that just read an older CURRENT can still open the file it named
+        cutoff = time.time() - grace_seconds
+        for name in os.listdir(self.snapshot_dir):
+            if not (name.startswith('snapshot_') and name.endswith('.db')) or name == snapshot_name:
+                continue
+            path = os.path.join(self.snapshot_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                # Another publisher already removed it
+                pass
+
+        return snapshot_path
+
+    def refresh_samples(self, cursor):
+        # Rebuild after every load. Rows are kept per stratum with probability P,
+        # and SAMPLE_WEIGHT = 1/P scales sample aggregates back up to the full table
+        for table, strata_column in self.SAMPLE_TABLES.items():
+            cursor.execute(f"DROP TABLE IF EXISTS {table}_SAMPLE")
+            cursor.execute(f'''
+                CREATE TABLE {table}_SAMPLE AS
+                SELECT t.*, 1.0 / s.P AS SAMPLE_WEIGHT
+                FROM {table} t
+                JOIN (
+                    SELECT {strata_column},
+                           MIN(1.0, MAX(?, ? * 1.0 / COUNT(*))) AS P
+                    FROM {table}
+                    GROUP BY {strata_column}
+                ) s ON t.{strata_column} IS s.{strata_column}
+                WHERE abs(random()) % 1000000 < s.P * 1000000
+            ''', (self.SAMPLE_RATE, self.SAMPLE_MIN_ROWS))
+
+    def current_snapshot_path(self):
+        pointer_path = os.path.join(self.snapshot_dir, 'CURRENT')
+        with open(pointer_path) as f:
+            return os.path.join(self.snapshot_dir, f.read().strip())
+
+    def connect_for_read(self):
+        if not self.snapshot_dir:
+            conn = sqlite3.connect(self.db_path)
+        else:
+            conn = self.connect_to_snapshot()
+
+        conn.create_aggregate('APPROX_COUNT_DISTINCT', 1, HyperLogLog)
+        return conn
+
+    def connect_to_snapshot(self, attempts=3):
+        for attempt in range(attempts):
+            # Snapshots never change once published, so skip locking entirely
+            # and let every worker share the OS page cache through mmap
+            snapshot_path = os.path.abspath(self.current_snapshot_path())
+            conn = None
+            try:
+                conn = sqlite3.connect(f"file:{snapshot_path}?mode=ro&immutable=1", uri=True)
+                conn.execute("PRAGMA mmap_size = 268435456")
+                # Force the file open now; once open it survives being unlinked
+                conn.execute("PRAGMA schema_version")
+                return conn
+            except sqlite3.OperationalError:
+                if conn:
+                    conn.close()
+                # The version we read may have been cleaned up; re-read CURRENT
+                if attempt == attempts - 1:
+                    raise
+
     def populate_sample_data(self, cursor):
         # Sample merchants with VARIANT data
         business_types = ['E-COMMERCE', 'SAAS', 'RETAIL', 'FOOD_BEVERAGE', 'GAMING', 'EDUCATION', 'HEALTHCARE']
@@ -206,8 +431,187 @@ class SnowflakePlatform:
         # Handle table references (remove schema prefixes for SQLite)
         translated = re.sub(r"PAYMENT_DB\.PUBLIC\.", "", translated, flags=re.IGNORECASE)
         
+        # SAMPLE (n) / TABLESAMPLE (n ROWS) to a random subquery
+        translated = re.sub(r"\b(FROM|JOIN)\s+(\w+)(\s+(?:AS\s+)?(?!SAMPLE\b|TABLESAMPLE\b)\w+)?\s+"
+                            r"(?:SAMPLE|TABLESAMPLE)\s*(?:BERNOULLI|ROW|SYSTEM|BLOCK)?\s*"
+                            r"\(\s*(\d+(?:\.\d+)?)\s*(ROWS)?\s*\)(?:\s*(?:REPEATABLE|SEED)\s*\(\s*\d+\s*\))?",
+                            lambda m: self.convert_sample(*m.groups()),
+                            translated, flags=re.IGNORECASE)
+        
         return translated
 
+    def convert_sample(self, keyword, table, alias, size, rows):
+        if rows:
+            subquery = f"(SELECT * FROM {table} ORDER BY random() LIMIT {int(float(size))})"
+        else:
+            # SQLite has no seeded sampling, so REPEATABLE/SEED is dropped
+            subquery = f"(SELECT * FROM {table} WHERE abs(random()) % 1000000 < {int(float(size) * 10000)})"
+        return f"{keyword} {subquery}{alias if alias else f' AS {table}'}"
+
+    def plan_approximate_query(self, translated_query):
+        # Only single-table COUNT/SUM/AVG queries over a sampled table can be
+        # answered from the sample; anything else returns None and runs exactly
+        # Blank out string literals so words inside them can't trip the checks
+        unquoted = re.sub(r"'(?:[^']|'')*'", "''", translated_query)
+        if len(re.findall(r"\bSELECT\b", unquoted, flags=re.IGNORECASE)) != 1:
+            return None
+        if re.search(r"\b(?:JOIN|UNION)\b|\b(?:MIN|MAX|TOTAL|GROUP_CONCAT|APPROX_COUNT_DISTINCT)\s*\("
+                     r"|\bSELECT\s+DISTINCT\b|\(\s*DISTINCT\b", unquoted, flags=re.IGNORECASE):
+            return None
+        if not re.search(r"\b(COUNT|SUM|AVG)\s*\(", translated_query, flags=re.IGNORECASE):
+            return None
+
+        from_index = next((i for i in top_level_positions(translated_query)
+                           if re.match(r"FROM\b", translated_query[i:], flags=re.IGNORECASE)
+                           and not re.match(r"\w", translated_query[i - 1])), None)
+        select_match = re.match(r"\s*SELECT\s", translated_query, flags=re.IGNORECASE)
+        if from_index is None or select_match is None:
+            return None
+
+        from_match = re.match(r"FROM\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", translated_query[from_index:], flags=re.IGNORECASE)
+        if from_match is None:
+            return None
+        table = from_match.group(1).upper()
+        if table not in self.SAMPLE_TABLES:
+            return None
+        alias = from_match.group(2)
+        from_end = from_match.end()
+        if alias and alias.upper() in ('WHERE', 'GROUP', 'ORDER', 'HAVING', 'LIMIT'):
+            alias = None
+            from_end = from_match.end(1)
+        sample_from = f"FROM {table}_SAMPLE {alias}" if alias else f"FROM {table}_SAMPLE AS {table}"
+        rest = sample_from + translated_query[from_index + from_end:]
+
+        # Error bounds use the Horvitz-Thompson variance for Bernoulli sampling,
+        # sum(w * (w - 1) * y^2), which needs only extra single-pass aggregates
+        items = split_top_level(translated_query[select_match.end():from_index])
+        aux_columns = []
+        bounds = []
+        rewritten_items = []
+        for item_index, item in enumerate(items):
+            if not re.search(r"\b(COUNT|SUM|AVG)\s*\(", item, flags=re.IGNORECASE):
+                rewritten_items.append(item)
+                continue
+            parsed = split_alias(item)
+            if parsed is None:
+                return None
+            expression, alias = parsed
+            expression = expression.strip()
+            # Aggregates inside larger expressions would have no error bound, so run exactly
+            agg_match = re.match(r"(COUNT|SUM|AVG)\s*\(", expression, flags=re.IGNORECASE)
+            if not agg_match or find_closing_paren(expression, agg_match.end() - 1) != len(expression) - 1:
+                return None
+            # Keep the column name the exact query would have produced
+            name = alias if alias else '"' + item.strip().replace('"', '""') + '"'
+            rewritten_items.append(f" {self.rewrite_aggregates(expression)} AS {name}")
+
+            func = agg_match.group(1).upper()
+            arg = expression[agg_match.end():-1].strip()
+            variance_weight = "SAMPLE_WEIGHT * (SAMPLE_WEIGHT - 1)"
+            if func == 'COUNT' and arg == '*':
+                exprs = [f"TOTAL({variance_weight})"]
+            elif func == 'COUNT':
+                exprs = [f"TOTAL(CASE WHEN ({arg}) IS NOT NULL THEN {variance_weight} END)"]
+            elif func == 'SUM':
+                exprs = [f"SUM({variance_weight} * ({arg}) * ({arg}))"]
+            else:
+                exprs = [f"SUM({variance_weight} * ({arg}) * ({arg}))",
+                         f"SUM({variance_weight} * ({arg}))",
+                         f"SUM(CASE WHEN ({arg}) IS NOT NULL THEN {variance_weight} END)",
+                         f"SUM(CASE WHEN ({arg}) IS NOT NULL THEN SAMPLE_WEIGHT END)"]
+            bounds.append({'column_index': item_index, 'func': func,
+                           'aux_indexes': list(range(len(items) + len(aux_columns), len(items) + len(aux_columns) + len(exprs)))})
+            aux_columns.extend(exprs)
+
+        # Sample rows behind each result row; with none, the variance is a meaningless 0
+        support_index = len(items) + len(aux_columns)
+        aux_columns.append("COUNT(*)")
+
+        select_list = ','.join(rewritten_items)
+        aux_list = ''.join(f", {expr} AS __APPROX_{i}" for i, expr in enumerate(aux_columns))
+        return {
+            'query': f"SELECT {select_list}{aux_list} {self.rewrite_aggregates(rest)}",
+            'visible_columns': len(items),
+            'bounds': bounds,
+            'support_index': support_index,
+            'sample_table': f"{table}_SAMPLE"
+        }
+
+    def rewrite_aggregates(self, sql):
+        # Swap each aggregate for its weighted estimator over the sample
+        pattern = re.compile(r"\b(COUNT|SUM|AVG)\s*\(", flags=re.IGNORECASE)
+        rewritten = ''
+        position = 0
+        for match in pattern.finditer(sql):
+            if match.start() < position:
+                continue
+            close_index = find_closing_paren(sql, match.end() - 1)
+            func = match.group(1).upper()
+            arg = sql[match.end():close_index].strip()
+            if func == 'COUNT' and arg == '*':
+                # TOTAL, unlike SUM, gives 0 rather than NULL when no sample rows match
+                estimate = "TOTAL(SAMPLE_WEIGHT)"
+            elif func == 'COUNT':
+                estimate = f"TOTAL(CASE WHEN ({arg}) IS NOT NULL THEN SAMPLE_WEIGHT END)"
+            elif func == 'SUM':
+                estimate = f"SUM(({arg}) * SAMPLE_WEIGHT)"
+            else:
+                estimate = f"(SUM(({arg}) * SAMPLE_WEIGHT) / SUM(CASE WHEN ({arg}) IS NOT NULL THEN SAMPLE_WEIGHT END))"
+            rewritten += sql[position:match.start()] + estimate
+            position = close_index + 1
+        return rewritten + sql[position:]
+
+    def error_bounds(self, plan, rows):
+        # 95% confidence half-widths, lined up with the result columns;
+        # None for columns without a bound and rows the sample doesn't cover
+        bounds = [None] * plan['visible_columns']
+        for bound in plan['bounds']:
+            margins = []
+            for row in rows:
+                if not row[plan['support_index']]:
+                    margins.append(None)
+                    continue
+                aux = [row[i] for i in bound['aux_indexes']]
+                if bound['func'] == 'AVG':
+                    squares, linear, weights, total_weight = aux
+                    estimate = row[bound['column_index']]
+                    if not total_weight or estimate is None:
+                        margins.append(None)
+                        continue
+                    variance = (squares - 2 * estimate * linear + estimate * estimate * weights) / (total_weight * total_weight)
+                else:
+                    variance = aux[0] or 0
+                margins.append(1.96 * math.sqrt(max(variance, 0)))
+            bounds[bound['column_index']] = margins
+        return bounds
+
+    def log_query(self, cursor, query, translated_query, started_at, duration_ms, row_count, approximate):
+        # Only paid for queries that actually get logged. The plan text shows
+        # aliases, so hash the real tables read too: otherwise a sample aliased
+        # to its base table's name hashes the same as a full scan
+        tables_read = set()
+        def collect_tables(action, table, column, database, trigger):
+            if action == sqlite3.SQLITE_READ and table:
+                tables_read.add(table)
+            return sqlite3.SQLITE_OK
+        cursor.connection.set_authorizer(collect_tables)
+        try:
+            cursor.execute(f"EXPLAIN QUERY PLAN {translated_query}")
+            plan = '\n'.join(row[3] for row in cursor.fetchall())
+        finally:
+            cursor.connection.set_authorizer(None)
+        plan += '\n' + ','.join(sorted(tables_read))
+        self.slow_query_log.record({
+            'timestamp': started_at,
+            'normalized_sql': normalize_sql(query),
+            'query': query,
+            'translated_query': translated_query,
+            'duration_ms': round(duration_ms, 3),
+            'row_count': row_count,
+            'approximate': approximate,
+            'plan_hash': hashlib.sha1(plan.encode()).hexdigest()[:16]
+        })
+
     def convert_date_trunc(self, unit, date_expr):
         unit = unit.upper()
         if unit == 'YEAR':
@@ -221,34 +625,67 @@ class SnowflakePlatform:
         else:
             return f"date({date_expr})"
 
-    def execute_query(self, query):
+    def execute_query(self, query, approximate=False):
         try:
             # Translate Snowflake syntax to SQLite
             translated_query = self.translate_snowflake_query(query)
             
-            conn = sqlite3.connect(self.db_path)
+            approximate_plan = self.plan_approximate_query(translated_query) if approximate else None
+            if approximate_plan:
+                translated_query = approximate_plan['query']
+            
+            conn = self.connect_for_read()
             cursor = conn.cursor()
             
+            # Wall-clock start for the log, so replays start each query on time
+            started_at = time.time()
+            started = time.perf_counter()
             cursor.execute(translated_query)
             columns = [description[0] for description in cursor.description] if cursor.description else []
             results = cursor.fetchall()
+            duration_ms = (time.perf_counter() - started) * 1000
+            
+            if self.slow_query_log and self.slow_query_log.should_log(duration_ms):
+                self.log_query(cursor, query, translated_query, started_at, duration_ms, len(results),
+                               approximate_plan is not None)
             
             conn.close()
             
-            return {
+            result = {
                 'success': True,
                 'columns': columns,
                 'data': results,
                 'row_count': len(results),
                 'translated_query': translated_query if translated_query != query else None
             }
+            
+            if approximate_plan:
+                visible = approximate_plan['visible_columns']
+                result['columns'] = columns[:visible]
+                result['data'] = [row[:visible] for row in results]
+                result['error_bounds'] = self.error_bounds(approximate_plan, results)
+                result['sample_table'] = approximate_plan['sample_table']
+            if approximate:
+                # False tells the caller the query was not eligible and ran exactly
+                result['approximate'] = approximate_plan is not None
+            
+            return result
         except Exception as e:
             return {
                 'success': False,
                 'error': str(e)
             }
 
-platform = SnowflakePlatform()
+slow_query_log = None
+if os.environ.get('SNOWFLAKE_SLOW_QUERY_LOG'):
+    slow_query_log = SlowQueryLog(
+        os.environ['SNOWFLAKE_SLOW_QUERY_LOG'],
+        threshold_ms=float(os.environ.get('SNOWFLAKE_SLOW_QUERY_MS', 100)),
+        sample_rate=float(os.environ.get('SNOWFLAKE_SLOW_QUERY_SAMPLE', 0))
+    )
+
+platform = SnowflakePlatform(snapshot_dir=os.environ.get('SNOWFLAKE_SNAPSHOT_DIR'),
+                             slow_query_log=slow_query_log)
 
 @app.route('/')
 def index():
@@ -264,15 +701,16 @@ def execute_sql():
     if not query.upper().startswith('SELECT'):
         return jsonify({'success': False, 'error': 'Only SELECT queries are allowed'})
     
-    result = platform.execute_query(query)
+    result = platform.execute_query(query, approximate=bool(request.json.get('approximate')))
     return jsonify(result)
 
 @app.route('/schema')
 def get_schema():
-    conn = sqlite3.connect(platform.db_path)
+    conn = platform.connect_for_read()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    # Sample tables back approximate queries and aren't part of the learner-facing schema
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE '%!_SAMPLE' ESCAPE '!'")
     tables = cursor.fetchall()
     
     schema_info = {}